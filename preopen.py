@@ -1,9 +1,15 @@
 import os
-import json
+import csv
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
 import gspread
-from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 
 # Setup basic logging
@@ -12,13 +18,56 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Fetch credentials and Sheet ID from environment variables
 SHEET_ID = "1IUChF0UFKMqVLxTI69lXBi-g48f-oTYqI1K9miipKgY"
 
+# Python type -> Sheets API ExtendedValue field, looked up by exact type
+CELL_VALUE_KEYS = {
+    bool: "boolValue",
+    int: "numberValue",
+    float: "numberValue",
+    str: "stringValue",
+}
+
+# NSE request headers and the page visited first to obtain session cookies
+NSE_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "application/json",
+    "Referer": "https://www.nseindia.com",
+}
+NSE_COOKIE_URL = "https://www.nseindia.com/market-data/pre-open-market-cm-and-emerge-market"
+NSE_FO_URL = "https://www.nseindia.com/api/market-data-pre-open?key=FO"
+
+# Upper bound for the wait between NSE fetch attempts, in seconds
+MAX_RETRY_DELAY = 30
+
+# Shared HTTP/2 client so every NSE request reuses one keep-alive connection
+nse_client = httpx.Client(
+    http2=True,
+    headers=NSE_HEADERS,
+    timeout=10.0,
+    follow_redirects=True,
+    limits=httpx.Limits(max_keepalive_connections=4),
+)
+
+# Metadata fields copied onto every pre-open row, in output column order
+METADATA_FIELDS = [
+    "symbol", "identifier", "purpose", "lastPrice", "change", "pChange",
+    "previousClose", "finalQuantity", "totalTurnover", "marketCap",
+    "yearHigh", "yearLow", "iep", "chartTodayPath",
+]
+
+# Pre-open record field -> output column name
+PREOPEN_FIELDS = {
+    "price": "preOpenPrice",
+    "buyQty": "buyQty",
+    "sellQty": "sellQty",
+}
+
 def authenticate_google_sheets():
     """Authenticate and return Google Sheets client."""
     credentials_json = os.getenv('GOOGLE_SHEETS_CREDENTIALS')  # JSON string
     if not credentials_json:
         raise ValueError("GOOGLE_SHEETS_CREDENTIALS environment variable is not set.")
 
-    credentials_info = json.loads(credentials_json)
+    credentials_info = orjson.loads(credentials_json)
     credentials = Credentials.from_service_account_info(
         credentials_info,
         scopes=["https://www.googleapis.com/auth/spreadsheets"]
@@ -32,66 +81,125 @@ def authenticate_google_sheets():
         logging.error(f"Google Sheets authentication failed: {e}")
         raise
 
-# Flatten any nested structures for uploading to Google Sheets
-def flatten_data(data):
-    """Flatten nested data (list or dictionary) to strings."""
-    if isinstance(data, dict):
-        return {key: str(value) for key, value in data.items()}  # Convert dict to string
-    elif isinstance(data, list):
-        return [str(item) if not isinstance(item, (dict, list)) else str(item) for item in data]  # Flatten lists
-    return data  # If data is already simple, return it unchanged
-
-def upload_to_google_sheets(sheet_id, tab_name, dataframe):
-    """Upload the provided dataframe to a Google Sheet."""
+@lru_cache(maxsize=None)
+def get_google_sheet(sheet_id):
+    """Return the opened spreadsheet, authenticating only on the first call."""
     client = authenticate_google_sheets()
-    sheet = client.open_by_key(sheet_id)
+    return client.open_by_key(sheet_id)
+
+# Flatten any nested structures for uploading to Google Sheets
+def flatten_data(dataframe):
+    """Convert nested values (lists or dictionaries) to strings, column by column."""
+    # Only object columns can hold nested values; numeric columns are left untouched
+    flattened = {}
+    for col in dataframe.select_dtypes(include="object").columns:
+        nested = dataframe[col].map(lambda value: isinstance(value, (dict, list)))
+        if nested.any():
+            flattened[col] = dataframe[col].where(~nested, dataframe[col].astype(str))
+    return dataframe.assign(**flattened) if flattened else dataframe
+
+def to_rows(dataframe):
+    """Return the dataframe as a list of rows with the header row first, shared by the CSV and Sheets outputs."""
+    # Flatten nested values in object columns only
+    dataframe = flatten_data(dataframe)
+
+    # Build the rows once with the header row prepended; missing values become None
+    rows = dataframe.to_numpy(dtype=object, na_value=None).tolist()
+    rows.insert(0, dataframe.columns.tolist())
+    return rows
+
+def to_cell_data(value):
+    """Convert a single value to a Sheets API CellData entry, stored as-is (like RAW input)."""
+    value_key = CELL_VALUE_KEYS.get(type(value))
+    if value_key is None:
+        if value is None:
+            return {}  # Empty cell (also clears any previous value)
+        if isinstance(value, np.generic):
+            return to_cell_data(value.item())  # Unwrap NumPy scalars to native Python values
+        return {"userEnteredValue": {"stringValue": str(value)}}
+    if value != value:
+        return {}  # NaN is written as an empty cell
+    return {"userEnteredValue": {value_key: value}}
+
+def upload_to_google_sheets(sheet_id, tab_name, rows, worksheets=None):
+    """Upload the provided rows (header row first) to a Google Sheet.
+
+    worksheets maps worksheet titles to already-fetched worksheets; when omitted,
+    the spreadsheet metadata is fetched here.
+    """
+    sheet = get_google_sheet(sheet_id)
+    if worksheets is None:
+        worksheets = {worksheet.title: worksheet for worksheet in sheet.worksheets()}
 
     # Try to find the worksheet or create a new one
     try:
-        worksheet = sheet.worksheet(tab_name)
-        worksheet.clear()  # Clear existing data
-        logging.info(f"Worksheet '{tab_name}' found, cleared existing data.")
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = sheet.add_worksheet(title=tab_name, rows=str(len(dataframe) + 1), cols=str(len(dataframe.columns)))
+        worksheet = worksheets[tab_name]
+        logging.info(f"Worksheet '{tab_name}' found, existing data will be replaced.")
+    except KeyError:
+        worksheet = sheet.add_worksheet(title=tab_name, rows=str(len(rows)), cols=str(len(rows[0])))
         logging.info(f"Worksheet '{tab_name}' not found. Created a new one.")
 
-    # Flatten the entire dataframe (one pass)
-    dataframe = dataframe.apply(lambda x: flatten_data(x))  # New line using lambda
-
-    # Update worksheet with DataFrame data
-    worksheet.update([dataframe.columns.values.tolist()] + dataframe.values.tolist())
+    # Clear the existing values, grow the grid if needed and write the data in one request
+    batch_requests = [{"updateCells": {"range": {"sheetId": worksheet.id}, "fields": "userEnteredValue"}}]
+    row_count = max(worksheet.row_count, len(rows))
+    col_count = max(worksheet.col_count, len(rows[0]))
+    if (row_count, col_count) != (worksheet.row_count, worksheet.col_count):
+        batch_requests.append({
+            "updateSheetProperties": {
+                "properties": {
+                    "sheetId": worksheet.id,
+                    "gridProperties": {"rowCount": row_count, "columnCount": col_count},
+                },
+                "fields": "gridProperties(rowCount,columnCount)",
+            }
+        })
+    batch_requests.append({
+        "updateCells": {
+            "start": {"sheetId": worksheet.id, "rowIndex": 0, "columnIndex": 0},
+            "rows": [{"values": [to_cell_data(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }
+    })
+    sheet.batch_update({"requests": batch_requests})
     logging.info(f"Data uploaded to '{tab_name}' successfully.")
 
+def save_all_data_to_google_sheets(sheet_id, uploads):
+    """Upload each (tab_name, rows) pair concurrently to its own worksheet."""
+    # Open the spreadsheet and list its worksheets once, shared by all the workers
+    sheet = get_google_sheet(sheet_id)
+    worksheets = {worksheet.title: worksheet for worksheet in sheet.worksheets()}
+
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        futures = [
+            executor.submit(upload_to_google_sheets, sheet_id, tab_name, rows, worksheets)
+            for tab_name, rows in uploads
+        ]
+        for future in futures:
+            future.result()  # Re-raise the first upload failure
+
+def write_csv(rows, path):
+    """Write the provided rows (header row first) to a CSV file."""
+    with open(path, "w", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerows(rows)
+
 # Function to fetch data from NSE and save to CSV
 def fetch_nse_data_with_retry(url, retries=3, delay=5):
     """Fetch data from NSE API with retries in case of failure."""
-    import requests
-    import time
-
     attempt = 0
     while attempt < retries:
         try:
-            # Initialize the session and set headers
-            session = requests.Session()
-            headers = {
-                "User-Agent": "Mozilla/5.0",
-                "Accept": "application/json",
-                "Referer": "https://www.nseindia.com",
-            }
-            session.headers.update(headers)
-
             # First, access the general page to get cookies
             logging.info("Accessing main NSE page to fetch cookies...")
-            session.get("https://www.nseindia.com/market-data/pre-open-market-cm-and-emerge-market", timeout=10)
+            nse_client.get(NSE_COOKIE_URL)
 
             # Now, access the FO data API
             logging.info(f"Fetching data from: {url}")
-            response = session.get(url, timeout=10)
+            response = nse_client.get(url)
 
             # Check if the response is valid
             if response.status_code == 200:
                 logging.info(f"Data fetched successfully: {type(response)}")
-                return response.json()  # Return the JSON response
+                return orjson.loads(response.content)  # Parse the raw bytes, skipping the str decode
             else:
                 logging.error(f"Failed to fetch data. Status code: {response.status_code}")
                 raise ValueError(f"Failed to fetch data from {url}. Status code: {response.status_code}")
@@ -99,98 +207,79 @@ def fetch_nse_data_with_retry(url, retries=3, delay=5):
         except Exception as e:
             attempt += 1
             logging.error(f"Attempt {attempt} failed: {e}")
+            nse_client.cookies.clear()  # Start the next attempt with fresh cookies
             if attempt < retries:
-                logging.info(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
+                # Exponential backoff with jitter, capped at MAX_RETRY_DELAY seconds
+                wait = min(delay * 2 ** (attempt - 1) + random.random() * 0.25, MAX_RETRY_DELAY)
+                logging.info(f"Retrying in {wait:.2f} seconds...")
+                time.sleep(wait)
             else:
                 logging.error(f"Failed after {retries} attempts.")
                 raise
 
-# Fetch FO data from NSE
-url_fo = "https://www.nseindia.com/api/market-data-pre-open?key=FO"
-nse_data = fetch_nse_data_with_retry(url_fo)
-
-if nse_data and "data" in nse_data:
-    # Initialize lists for storing the cleaned data
-    cleaned_data = []
-    preopen_summary = {}
-
-    # Extract the summary for Advance, Declines, Unchanged
-    if "advances" in nse_data:
-        preopen_summary["Advances"] = nse_data["advances"]
-    if "declines" in nse_data:
-        preopen_summary["Declines"] = nse_data["declines"]
-    if "unchanged" in nse_data:
-        preopen_summary["Unchanged"] = nse_data["unchanged"]
-
-    # Process each item in the "data" list
-    for item in nse_data["data"]:
-        # Extract metadata
-        symbol = item["metadata"]["symbol"]
-        identifier = item["metadata"]["identifier"]
-        purpose = item["metadata"]["purpose"]
-        last_price = item["metadata"]["lastPrice"]
-        change = item["metadata"]["change"]
-        p_change = item["metadata"]["pChange"]
-        previous_close = item["metadata"]["previousClose"]
-        final_quantity = item["metadata"]["finalQuantity"]
-        total_turnover = item["metadata"]["totalTurnover"]
-        market_cap = item["metadata"]["marketCap"]
-        year_high = item["metadata"]["yearHigh"]
-        year_low = item["metadata"]["yearLow"]
-        iep = item["metadata"]["iep"]
-        chart_today_path = item["metadata"]["chartTodayPath"]
-
-        # Extract pre-open market data
-        pre_open_data = item["detail"]["preOpenMarket"]["preopen"]
-        for pre_open in pre_open_data:
-            price = pre_open["price"]
-            buy_qty = pre_open["buyQty"]
-            sell_qty = pre_open["sellQty"]
-            
-            # Append the data as a row in the cleaned data list
-            cleaned_data.append({
-                "symbol": symbol,
-                "identifier": identifier,
-                "purpose": purpose,
-                "lastPrice": last_price,
-                "change": change,
-                "pChange": p_change,
-                "previousClose": previous_close,
-                "finalQuantity": final_quantity,
-                "totalTurnover": total_turnover,
-                "marketCap": market_cap,
-                "yearHigh": year_high,
-                "yearLow": year_low,
-                "iep": iep,
-                "chartTodayPath": chart_today_path,
-                "preOpenPrice": price,
-                "buyQty": buy_qty,
-                "sellQty": sell_qty
-            })
-    
-    # Convert cleaned data to DataFrame
-    df = pd.DataFrame(cleaned_data)
-    
-    # Remove duplicates based on 'symbol', 'preOpenPrice', 'buyQty', and 'sellQty'
-    df = df.drop_duplicates(subset=['symbol', 'pChange', 'lastPrice', 'previousClose'], keep='first')
-        
-    # Upload the cleaned data to Google Sheets
-    upload_to_google_sheets(SHEET_ID, "Preopen", df)
-
-    # Save the Preopen data to a CSV file
-    df.to_csv("Preopen.csv", index=False)
-    logging.info("Preopen data saved to 'Preopen.csv'.")
-
-    # Convert the summary data to DataFrame for Advances, Declines, Unchanged
-    preopen_summary_df = pd.DataFrame([preopen_summary])
-
-    # Upload the summary data to Google Sheets
-    upload_to_google_sheets(SHEET_ID, "FO Preopen Data", preopen_summary_df)
-
-    # Save the FO Preopen data to a CSV file
-    preopen_summary_df.to_csv("FO Preopen Data.csv", index=False)
-    logging.info("FO Preopen data saved to 'FO Preopen Data.csv'.")
-
-else:
-    logging.error("No 'data' found in the response.")
+def main():
+    """Fetch the FO pre-open data, upload it to Google Sheets and save it to CSV."""
+    # Fetch FO data from NSE
+    nse_data = fetch_nse_data_with_retry(NSE_FO_URL)
+
+    if nse_data and "data" in nse_data:
+        preopen_summary = {}
+
+        # Extract the summary for Advance, Declines, Unchanged
+        if "advances" in nse_data:
+            preopen_summary["Advances"] = nse_data["advances"]
+        if "declines" in nse_data:
+            preopen_summary["Declines"] = nse_data["declines"]
+        if "unchanged" in nse_data:
+            preopen_summary["Unchanged"] = nse_data["unchanged"]
+
+        # Build one list per output column (structure of arrays) in a single pass
+        preopen_lists = [item["detail"]["preOpenMarket"]["preopen"] for item in nse_data["data"]]
+        row_count = sum(len(pre_open_data) for pre_open_data in preopen_lists)
+        columns = {name: [None] * row_count for name in [*METADATA_FIELDS, *PREOPEN_FIELDS.values()]}
+        start = 0
+        for item, pre_open_data in zip(nse_data["data"], preopen_lists):
+            end = start + len(pre_open_data)
+            metadata = item["metadata"]
+            for field in METADATA_FIELDS:
+                columns[field][start:end] = [metadata[field]] * len(pre_open_data)
+            for source, name in PREOPEN_FIELDS.items():
+                columns[name][start:end] = [pre_open[source] for pre_open in pre_open_data]
+            start = end
+        df = pd.DataFrame(columns, copy=False)
+
+        # Remove duplicates based on 'symbol', 'pChange', 'lastPrice', and 'previousClose',
+        # keeping the first occurrence of each row hash. Adding 0.0 turns -0.0 into 0.0 so
+        # signed zeros hash equal, as they compare in drop_duplicates. Object columns are
+        # hashed by their string form, so 1 and '1' would merge; 'symbol' is always a string.
+        keys = df[['symbol', 'pChange', 'lastPrice', 'previousClose']]
+        keys = keys.assign(**{col: keys[col] + 0.0 for col in keys.select_dtypes(include="float").columns})
+        row_hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+        _, first_rows = np.unique(row_hashes, return_index=True)
+        df = df.iloc[np.sort(first_rows)].reset_index(drop=True)
+
+        # Materialize the rows once; both the Sheets upload and the CSV reuse them
+        preopen_rows = to_rows(df)
+
+        # Summary rows for Advances, Declines, Unchanged: header plus a single value row
+        preopen_summary_rows = [list(preopen_summary), list(preopen_summary.values())]
+
+        # Upload the cleaned data and the summary to Google Sheets
+        save_all_data_to_google_sheets(SHEET_ID, [
+            ("Preopen", preopen_rows),
+            ("FO Preopen Data", preopen_summary_rows),
+        ])
+
+        # Save the Preopen data to a CSV file
+        write_csv(preopen_rows, "Preopen.csv")
+        logging.info("Preopen data saved to 'Preopen.csv'.")
+
+        # Save the FO Preopen data to a CSV file
+        write_csv(preopen_summary_rows, "FO Preopen Data.csv")
+        logging.info("FO Preopen data saved to 'FO Preopen Data.csv'.")
+
+    else:
+        logging.error("No 'data' found in the response.")
+
+if __name__ == "__main__":
+    main()